@@ -4,12 +4,12 @@
 # Purpose: Extract school data from JSON file, transform it, and load into PostgreSQL database
 
 # Import required libraries
+# Heavy libraries (pandas, pyarrow, Postgres hook) are imported inside the task
+# functions so the scheduler does not pay for them on every DAG file parse
 from datetime import datetime, timedelta
 from airflow import DAG
 from airflow.operators.python_operator import PythonOperator
-from airflow.providers.postgres.hooks.postgres import PostgresHook
-import pandas as pd
-import json
+from airflow.utils.trigger_rule import TriggerRule
 
 # ==========================================
 # DAG CONFIGURATION
@@ -30,7 +30,20 @@ default_args = {
 # EXTRACTION FUNCTIONS
 # ==========================================
 
-def fetch_data_from_json(file_path):
+# File name of extracted school records staged between tasks, written inside the
+# staging directory given by the 'sekolah_staging_dir' Airflow Variable
+# One file is written per shard; {shard} is replaced with the shard number
+extract_output_file = 'sekolah_{shard}.parquet'
+
+# Staged Parquet files use zstd compression with dictionary-encoded columns,
+# which keeps repetitive text columns small at low CPU cost
+parquet_compression_level = 3
+
+# Record field used to split schools into shards that are transformed and
+# loaded in parallel (province code)
+shard_column = 'kode_prop'
+
+def fetch_data_from_json(file_path, staging_dir):
     """
     Extract data from JSON file containing Indonesian school information
     
@@ -38,65 +51,147 @@ def fetch_data_from_json(file_path):
     
     Args:
         file_path (str): Path to the JSON file containing school data
+        staging_dir (str): Directory for staged Parquet files; must be on storage
+            every Airflow worker can reach, since downstream tasks read from it
     
     Returns:
-        dict: Complete JSON data as Python dictionary containing school information
+        list: One {'extract_path': str} entry per province shard, each pointing to
+        a Parquet file holding one row per public high school
         
-    Note: This function replaces API calls to work with local data files
+    Note: This function replaces API calls to work with local data files.
+    Records are parsed with orjson and staged as Parquet, so only file paths
+    (not the full JSON document) are passed through XCom. The returned list
+    drives dynamic task mapping of the transform and load tasks.
     """
-    with open(file_path, 'r', encoding='utf-8') as file:
-        data = json.load(file)
-    return data
+    import mmap
+    import os
+    import orjson
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    # Parse the JSON document with orjson straight from a memory-mapped view of
+    # the file, avoiding a full-size bytes copy (orjson needs a memoryview, not mmap)
+    with open(file_path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                data = orjson.loads(view)
+    
+    # Extract the school records from the nested JSON structure, keeping only
+    # public high schools so the DataFrame is sized to the output, not the input
+    # 'N' = Negeri (Public), 'SMA' = Sekolah Menengah Atas (High School)
+    # Matching records are grouped by province so each shard runs independently
+    shards = {}
+    fields = {}
+    for record in data['dataSekolah']:
+        if record.get('bentuk') == 'SMA' and record.get('status') == 'N':
+            # Track the union of fields over all matching records, in first-seen order
+            fields.update(dict.fromkeys(record))
+            
+            # Keep raw values as text: JSON numbers and strings can be mixed across
+            # records (e.g. "lintang": "-6.1" vs -6.3); the transform task parses them
+            shards.setdefault(record.get(shard_column), []).append({
+                key: value if value is None or isinstance(value, str) else orjson.dumps(value).decode()
+                for key, value in record.items()
+            })
+    
+    # One explicit schema for every shard: without it pyarrow takes the columns
+    # from the first record only, dropping fields that first record lacks
+    schema = pa.schema([(field, pa.string()) for field in fields])
+    
+    # Build columnar Arrow buffers directly from the records (no pandas pivot),
+    # stage each shard on disk and hand only the paths to the next task
+    os.makedirs(staging_dir, exist_ok=True)
+    shard_paths = []
+    for shard, records in enumerate(shards.values()):
+        extract_path = os.path.join(staging_dir, extract_output_file.format(shard=shard))
+        pq.write_table(
+            pa.Table.from_pylist(records, schema=schema), 
+            extract_path, 
+            compression='zstd', 
+            compression_level=parquet_compression_level, 
+            use_dictionary=True
+        )
+        shard_paths.append({'extract_path': extract_path})
+    return shard_paths
 
 # ==========================================
 # TRANSFORMATION FUNCTIONS
 # ==========================================
 
-def transform_data(**kwargs):
+# File name of transformed school data staged for loading, written next to the
+# extracted shard (i.e. in the same staging directory)
+# {shard} is replaced with the map index of the transform task instance
+transform_output_file = 'sekolah_transformed_{shard}.parquet'
+
+def transform_data(extract_path, **kwargs):
     """
     Transform raw school data according to business requirements
     
-    Purpose: Clean, filter, and enhance school data for analytical purposes
+    Purpose: Clean and enhance school data for analytical purposes
     
     Transformations Applied:
-    1. Filter for public high schools only (status='N' and bentuk='SMA')
-    2. Create combined school address field
-    3. Convert coordinates to numeric format
-    4. Remove records with missing coordinate data
+    1. Convert coordinates to numeric format
+    2. Remove records with missing coordinate data
+    3. Create combined school address field
+    
+    Note: Filtering for public high schools (status='N' and bentuk='SMA')
+    happens during extraction, before the DataFrame is built.
     
     Args:
+        extract_path (str): Path to one province shard staged by the extract task
         **kwargs: Airflow context containing task instance for XCom communication
         
     Returns:
-        pandas.DataFrame: Cleaned and transformed school data ready for database loading
+        dict: {'transform_path': str} pointing to the Parquet file holding
+        transformed data ready for database loading
     """
-    # Extract data from previous task using XCom
-    data = kwargs['ti'].xcom_pull(task_ids='fetch_data_from_api')
-    
-    # Extract the school data from the nested JSON structure
-    sekolah_data = data['dataSekolah']
-    
-    # Convert JSON data to pandas DataFrame for easier manipulation
-    df = pd.DataFrame(sekolah_data)
+    import os
+    import pandas as pd
     
-    # TRANSFORMATION 1: Filter data for public high schools only
-    # 'N' = Negeri (Public), 'SMA' = Sekolah Menengah Atas (High School)
-    transformed_df = df[(df['status'].str.contains('N')) & (df['bentuk'] == 'SMA')]
-    
-    # TRANSFORMATION 2: Create enhanced address field
-    # Combine school name with street address for better identification
-    transformed_df['school_address'] = transformed_df['sekolah'] + " - " + transformed_df['alamat_jalan']
+    # Load public high school records into pandas DataFrame for easier manipulation
+    # Every shard shares the extract schema of raw text fields; keep them as
+    # Arrow-backed strings so string operations run in vectorized Arrow kernels
+    # and a column that is all-null in this shard is still staged as text, giving
+    # every shard the same staging table columns and types
+    df = pd.read_parquet(extract_path).astype('string[pyarrow]')
     
-    # TRANSFORMATION 3: Convert coordinate columns to numeric data type
+    # TRANSFORMATION 1: Convert coordinate columns to numeric data type
     # This ensures proper data types for geographical analysis
-    transformed_df['lintang'] = pd.to_numeric(transformed_df['lintang'], errors='coerce')  # Latitude
-    transformed_df['bujur'] = pd.to_numeric(transformed_df['bujur'], errors='coerce')      # Longitude
+    # pd.to_numeric parses strings in compiled code and coerces malformed
+    # values to NaN; pd.array(..., dtype='Float64') would raise instead
+    lintang = pd.to_numeric(df['lintang'], errors='coerce')  # Latitude
+    bujur = pd.to_numeric(df['bujur'], errors='coerce')      # Longitude
     
-    # TRANSFORMATION 4: Data quality - remove records with missing coordinates
+    # TRANSFORMATION 2: Data quality - keep only records with valid coordinates
     # Essential for location-based analysis and mapping
-    transformed_df = transformed_df.dropna(subset=['lintang', 'bujur'])
+    # A single boolean mask selects the surviving rows in one gather
+    valid = lintang.notna() & bujur.notna()
+    
+    # Build all output columns in a single assign() over the surviving rows only
+    transformed_df = df.loc[valid].assign(
+        # TRANSFORMATION 3: Create enhanced address field
+        # Combine school name with street address for better identification
+        school_address=lambda x: x['sekolah'] + " - " + x['alamat_jalan'],
+        # Store coordinates as float32 (REAL in Postgres) to halve their size on
+        # the wire; ~7 significant digits is roughly metre-level precision
+        lintang=lintang[valid].astype('float32'),
+        bujur=bujur[valid].astype('float32')
+    )
     
-    return transformed_df
+    # Stage transformed data on disk and hand only the path to the load task
+    transform_path = os.path.join(
+        os.path.dirname(extract_path), 
+        transform_output_file.format(shard=kwargs['ti'].map_index)
+    )
+    transformed_df.to_parquet(
+        transform_path, 
+        engine='pyarrow', 
+        index=False, 
+        compression='zstd', 
+        compression_level=parquet_compression_level, 
+        use_dictionary=True
+    )
+    return {'transform_path': transform_path}
 
 # ==========================================
 # LOADING FUNCTIONS
@@ -105,53 +200,204 @@ def transform_data(**kwargs):
 # Define target database schema (customize as needed)
 custom_schema = 'hijir'
 
-def load_data_to_database(**kwargs):
+# Define target table name within the schema
+target_table = 'target_table'
+
+# Define load strategy: 'copy' (COPY FROM STDIN) or 'insert' (batched multi-row INSERTs)
+load_method = 'copy'
+
+# Number of rows sent per multi-row INSERT statement when load_method is 'insert'
+insert_chunksize = 10000
+
+def get_database_engine():
     """
-    Load transformed data into PostgreSQL database
+    Build the SQLAlchemy engine for the Airflow 'postgres' connection
     
-    Purpose: Store processed school data in database for further analysis and reporting
+    Returns:
+        sqlalchemy.engine.Engine: Engine with psycopg2 batched executemany
+        
+    Note: The engine is created inside the task, never at DAG parse time.
+    """
+    from airflow.providers.postgres.hooks.postgres import PostgresHook
+    
+    postgres_hook = PostgresHook(postgres_conn_id='postgres')
+    
+    # executemany_mode='values_plus_batch': psycopg2 expands each executemany
+    # into INSERT ... VALUES (...), (...) pages of insert_chunksize rows
+    return postgres_hook.get_sqlalchemy_engine(engine_kwargs={
+        'executemany_mode': 'values_plus_batch',
+        'executemany_values_page_size': insert_chunksize
+    })
+
+def load_data_to_database(transform_path, **kwargs):
+    """
+    Load one transformed shard into its own PostgreSQL staging table
+    
+    Purpose: Stage processed school data so all shards can load in parallel
     
     Process:
-    1. Retrieve transformed data from previous task
+    1. Retrieve transformed shard staged by previous task
     2. Connect to PostgreSQL using Airflow connection
-    3. Create table with appropriate schema if it doesn't exist
-    4. Load data into target table, replacing existing data
+    3. Recreate the shard's staging table with appropriate schema
+    4. Bulk load data using COPY FROM STDIN
+       (or batched multi-row INSERTs when load_method is 'insert')
     
     Args:
+        transform_path (str): Path to one transformed shard staged by the transform task
         **kwargs: Airflow context containing task instance for XCom communication
         
+    Returns:
+        str: Name of the staging table holding this shard
+        
     Database Details:
     - Schema: hijir (customizable)
-    - Table: target_table
-    - Load Strategy: Replace existing data
+    - Table: target_table_shard_<n> (merged into target_table afterwards)
+    - Load Strategy: Recreate staging table, then COPY
     """
-    # Get transformed data from previous task
-    transformed_data = kwargs['ti'].xcom_pull(task_ids='transform_data')
+    import io
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+    from psycopg2 import sql
+    
+    # Get transformed data staged by previous task (XCom carries only the path)
+    # Read as an Arrow table so the COPY path never materializes pandas objects
+    transformed_data = pq.read_table(transform_path)
     
     # Establish connection to PostgreSQL database using Airflow connection
-    postgres_hook = PostgresHook(postgres_conn_id='postgres')
+    engine = get_database_engine()
     
     # Analyze data types of transformed data for table creation
-    # Default to TEXT type for all columns to avoid data type conflicts
-    data_types = {col: 'TEXT' for col, dtype in transformed_data.dtypes.items()}
-    
-    # Create table if it doesn't exist in the specified schema
-    create_query = f"""
-    CREATE TABLE IF NOT EXISTS {custom_schema}.target_table (
-        {', '.join([f'{col} {data_types[col]}' for col in transformed_data.columns])}
-    );
-    """
-    postgres_hook.run(create_query)
-    
-    # Load transformed data into the database table
-    # if_exists='replace': Drops and recreates table with new data
-    transformed_data.to_sql(
-        'target_table', 
-        postgres_hook.get_sqlalchemy_engine(), 
-        schema=custom_schema, 
-        if_exists='replace', 
-        index=False
+    # Only the float32 coordinates (lintang, bujur) are numeric and become REAL;
+    # every other field is staged as text by extract/transform and becomes TEXT
+    data_types = {
+        field.name: 'REAL' if pa.types.is_float32(field.type) else 'TEXT'
+        for field in transformed_data.schema
+    }
+    
+    # Each shard gets its own staging table so mapped load tasks never contend
+    staging_table = f"{target_table}_shard_{kwargs['ti'].map_index}"
+    
+    # Compose statements with quoted identifiers so schema, table and column
+    # names are never spliced into SQL text as raw strings
+    table = sql.Identifier(custom_schema, staging_table)
+    columns = sql.SQL(', ').join(sql.Identifier(col) for col in transformed_data.column_names)
+    
+    # Recreate the staging table (UNLOGGED: it is rebuilt every run, so skip WAL)
+    create_query = sql.SQL('DROP TABLE IF EXISTS {0}; CREATE UNLOGGED TABLE {0} ({1})').format(
+        table,
+        sql.SQL(', ').join(
+            sql.SQL('{} {}').format(sql.Identifier(col), sql.SQL(data_types[col]))
+            for col in transformed_data.column_names
+        )
     )
+    
+    if load_method == 'insert':
+        # Fallback: load with pandas using batched multi-row INSERT statements
+        # if_exists='append': Keeps the staging table definition created above
+        with engine.begin() as connection:
+            with connection.connection.cursor() as cursor:
+                cursor.execute(create_query)
+            transformed_data.to_pandas().to_sql(
+                staging_table, 
+                connection, 
+                schema=custom_schema, 
+                if_exists='append', 
+                index=False,
+                chunksize=insert_chunksize
+            )
+    else:
+        # Serialize the Arrow table into an in-memory CSV buffer for COPY
+        # Arrow quotes every string and writes nulls as unquoted empty fields,
+        # which COPY's CSV format reads back as NULL
+        buffer = io.BytesIO()
+        pa_csv.write_csv(transformed_data, buffer, pa_csv.WriteOptions(include_header=False))
+        buffer.seek(0)
+        
+        # Load transformed data into the staging table using COPY FROM STDIN
+        # COPY streams all rows in a single operation instead of one INSERT per row
+        copy_query = sql.SQL(
+            'COPY {} ({}) FROM STDIN WITH (FORMAT CSV)'
+        ).format(table, columns)
+        
+        # raw_connection() checks a psycopg2 connection out of the engine pool;
+        # close() returns it to the pool instead of disconnecting
+        conn = engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(create_query)
+                cursor.copy_expert(copy_query, buffer)
+            conn.commit()
+        finally:
+            conn.close()
+    
+    return staging_table
+
+def merge_shards_to_target(**kwargs):
+    """
+    Merge all loaded staging tables into the target table
+    
+    Purpose: Publish the shards loaded in parallel as one consistent table
+    
+    Process:
+    1. Retrieve staging table names from all mapped load tasks
+       (none when extract found no records; the target table is then emptied)
+    2. Create target table with the staging layout if it doesn't exist
+    3. Truncate target table and copy every shard in, in one transaction
+    4. Drop the staging tables
+    
+    Args:
+        **kwargs: Airflow context containing task instance for XCom communication
+        
+    Database Details:
+    - Schema: hijir (customizable)
+    - Table: target_table
+    - Load Strategy: Replace existing data (TRUNCATE + INSERT ... SELECT)
+    """
+    from psycopg2 import sql
+    
+    # Get staging table names returned by every mapped load task instance
+    # Empty when extract found no matching records (mapped tasks were skipped)
+    staging_tables = list(kwargs['ti'].xcom_pull(task_ids='load_data_to_database') or [])
+    
+    table = sql.Identifier(custom_schema, target_table)
+    
+    conn = get_database_engine().raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            if not staging_tables:
+                # No shards: still replace the previous run's rows with nothing,
+                # provided the target table has been created by an earlier run
+                cursor.execute('SELECT to_regclass(%s)', [table.as_string(cursor)])
+                if cursor.fetchone()[0] is not None:
+                    cursor.execute(sql.SQL('TRUNCATE {}').format(table))
+                conn.commit()
+                return
+            
+            first_staging = sql.Identifier(custom_schema, staging_tables[0])
+            
+            # Create table if it doesn't exist, copying the staging column types
+            cursor.execute(
+                sql.SQL('CREATE TABLE IF NOT EXISTS {} (LIKE {})').format(table, first_staging)
+            )
+            
+            # All shards share the same columns; list them explicitly so the
+            # merge does not depend on the target table's column order
+            cursor.execute(sql.SQL('SELECT * FROM {} LIMIT 0').format(first_staging))
+            columns = sql.SQL(', ').join(sql.Identifier(desc[0]) for desc in cursor.description)
+            
+            # TRUNCATE: Replace existing data while keeping the table definition
+            # Readers never see a partial table since everything commits at once
+            cursor.execute(sql.SQL('TRUNCATE {}').format(table))
+            for staging_table in staging_tables:
+                staging = sql.Identifier(custom_schema, staging_table)
+                cursor.execute(
+                    sql.SQL('INSERT INTO {0} ({1}) SELECT {1} FROM {2}').format(table, columns, staging)
+                )
+                cursor.execute(sql.SQL('DROP TABLE {}').format(staging))
+        conn.commit()
+    finally:
+        conn.close()
 
 # ==========================================
 # DAG DEFINITION
@@ -163,7 +409,8 @@ with DAG(
     default_args=default_args,            # Apply default arguments
     start_date=datetime(2024, 5, 1),      # DAG start date
     schedule_interval='@daily',           # Run daily
-    catchup=False                         # Don't run for past dates
+    catchup=False,                        # Don't run for past dates
+    max_active_runs=1                     # Shard files and staging tables use fixed names, so runs must not overlap
 ) as dag:
     
     # ==========================================
@@ -174,29 +421,46 @@ with DAG(
     extract_task = PythonOperator(
         task_id='fetch_data_from_api',    # Task identifier
         python_callable=fetch_data_from_json,  # Function to execute
-        # Note: Add file_path parameter when calling this task
+        # JSON path comes from the 'sekolah_json_path' Airflow Variable, rendered
+        # at task runtime so changing it does not require editing the DAG file
+        # Staging directory comes from the 'sekolah_staging_dir' Airflow Variable
+        # and must be shared storage when tasks run on more than one worker
+        op_kwargs={
+            'file_path': '{{ var.value.get("sekolah_json_path", "/data/school_data.json") }}',
+            'staging_dir': '{{ var.value.get("sekolah_staging_dir", "/tmp") }}'
+        }
     )
     
     # TRANSFORM TASK: Clean and process the data
-    transform_task = PythonOperator(
+    # Dynamically mapped: one task instance per province shard (Airflow 2.3+)
+    transform_task = PythonOperator.partial(
         task_id='transform_data',         # Task identifier
-        python_callable=transform_data,   # Function to execute
-        provide_context=True              # Enable access to Airflow context and XCom
-    )
+        python_callable=transform_data    # Function to execute
+    ).expand(op_kwargs=extract_task.output)
     
-    # LOAD TASK: Store data in PostgreSQL database
-    load_task = PythonOperator(
+    # LOAD TASK: Store each shard in its own PostgreSQL staging table
+    # Dynamically mapped: one task instance per transformed shard
+    load_task = PythonOperator.partial(
         task_id='load_data_to_database',  # Task identifier
-        python_callable=load_data_to_database,  # Function to execute
-        provide_context=True              # Enable access to Airflow context and XCom
+        python_callable=load_data_to_database  # Function to execute
+    ).expand(op_kwargs=transform_task.output)
+    
+    # MERGE TASK: Publish all staged shards into the target table
+    merge_task = PythonOperator(
+        task_id='merge_shards_to_target', # Task identifier
+        python_callable=merge_shards_to_target,  # Function to execute
+        # Also run when the mapped tasks expanded to zero instances (skipped),
+        # so an empty extract still replaces the previous run's rows
+        trigger_rule=TriggerRule.NONE_FAILED
     )
     
     # ==========================================
     # TASK DEPENDENCIES (ETL PIPELINE FLOW)
     # ==========================================
     
-    # Define execution order: Extract → Transform → Load
-    extract_task >> transform_task >> load_task
+    # Define execution order: Extract → Transform (per shard) → Load (per shard) → Merge
+    # Extract → Transform → Load are already linked through the mapped XCom inputs
+    load_task >> merge_task
 
 # ==========================================
 # PIPELINE SUMMARY
@@ -204,12 +468,14 @@ with DAG(
 """
 ETL Pipeline Flow:
 1. EXTRACT: Read high school data from JSON file
-2. TRANSFORM: 
    - Filter for public high schools only
+   - Split records into province shards
+2. TRANSFORM (one mapped task per shard): 
    - Create enhanced address fields
    - Convert coordinates to numeric format
    - Remove records with missing location data
-3. LOAD: Store processed data in PostgreSQL database
+3. LOAD (one mapped task per shard): Store processed shard in a staging table
+4. MERGE: Replace target table contents with all staged shards
 
 Schedule: Daily execution
 Target: High schools with valid coordinate data